@@ -32,8 +32,12 @@ ALLOWED_HOSTS = ['*']
 GEMINI_API_KEY = os.getenv('DJANGO_SECRET_KEY', 'unsafe-default-for-dev')  
 OPENROUTER_API_URL = 'https://openrouter.ai/api/v1/chat/completions'
 
+# 识别建筑用的 Gemini 模型；回答不符合 JSON 格式时改用 fallback 模型重试（留空则不重试）
+GEMINI_MODEL_NAME = os.getenv('GEMINI_MODEL_NAME', 'gemini-2.5-flash')
+GEMINI_FALLBACK_MODEL_NAME = os.getenv('GEMINI_FALLBACK_MODEL_NAME', 'gemini-2.5-pro')
 
-MAP_PDF_PATH = os.path.join(BASE_DIR,  'output_map.png')
+# (GPS 网格, 方向) -> 建筑名 的缓存时间（秒）
+LOCATION_CACHE_TTL = 60 * 60 * 24
 
 # Application definition
 
@@ -88,6 +92,18 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# 多个 worker 部署时改用 Redis，让识别结果在进程间共享：
+# "BACKEND": "django.core.cache.backends.redis.RedisCache", "LOCATION": "redis://127.0.0.1:6379"
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
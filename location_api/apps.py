@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class LocationApiConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "location_api"
+
+    def ready(self):
+        # 启动时预先加载 YOLO 权重，避免第一个请求承担冷启动开销
+        from .views import get_yolo
+        get_yolo()
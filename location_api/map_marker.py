@@ -0,0 +1,132 @@
+# location_api/map_marker.py
+
+import math
+
+import cv2
+import numpy as np
+from PIL import Image, ImageColor
+
+
+# 已解码的底图缓存：图片路径 -> 只读的 BGRA 像素数组（OpenCV 通道顺序）
+_BASE_MAPS = {}
+
+def load_base_map(image_path):
+    """
+    读取底图并缓存解码后的像素，避免每个请求重复解码 PNG
+    """
+    base_map = _BASE_MAPS.get(image_path)
+    if base_map is None:
+        rgba = np.asarray(Image.open(image_path).convert('RGBA'))
+        base_map = cv2.cvtColor(rgba, cv2.COLOR_RGBA2BGRA)
+        base_map.flags.writeable = False
+        _BASE_MAPS[image_path] = base_map
+    return base_map
+
+
+class MapMarker:
+    # 箭头各顶点在箭头自身坐标系下的位置（单位为 size，x 轴指向箭头方向）：
+    # 尖端、左翼（+150°）、右翼（-150°）、箭头杆末端
+    _ARROW_BODY = np.array([
+        [0.3, 0.0],
+        [0.5 * math.cos(math.radians(150)), 0.5 * math.sin(math.radians(150))],
+        [0.5 * math.cos(math.radians(-150)), 0.5 * math.sin(math.radians(-150))],
+        [-2.0, 0.0],
+    ])
+
+    def __init__(self, image_path, corners):
+        """
+        初始化地图标记器
+        
+        Args:
+            image_path: 地图图片路径
+            corners: 地图四个角的经纬度，格式：
+                {
+                    'top_left': (lat, lon),
+                    'top_right': (lat, lon),
+                    'bottom_left': (lat, lon),
+                    'bottom_right': (lat, lon)
+                }
+        """
+        base_map = load_base_map(image_path)
+        # 直接在 BGRA 像素数组上绘制，只在编码时才交给 OpenCV / Pillow
+        self.image = base_map.copy()
+        self.height, self.width = base_map.shape[:2]
+        self.corners = corners
+
+        # 角点固定不变，预先算好线性插值的偏移和比例
+        lats = [lat for lat, _ in corners.values()]
+        lons = [lon for _, lon in corners.values()]
+        lat_min, lat_max = min(lats), max(lats)
+        lon_min, lon_max = min(lons), max(lons)
+        self._lon0, self._lonk = lon_min, self.width / (lon_max - lon_min)
+        self._lat1, self._latk = lat_max, self.height / (lat_max - lat_min)
+        
+    def latlon_to_pixel(self, lat, lon):
+        """
+        将经纬度转换为图片像素坐标
+        
+        使用简单的线性插值（适用于小范围地图）
+        """
+        # 注意：纬度是反向的（北纬越大，y 坐标越小）
+        x = (lon - self._lon0) * self._lonk
+        y = (self._lat1 - lat) * self._latk
+        
+        return int(x), int(y)
+    
+    def draw_arrow(self, lat, lon, direction, color='red', size=50):
+        """
+        在指定经纬度位置画箭头
+        
+        Args:
+            lat: 纬度
+            lon: 经度
+            direction: 方向角度（0-360度，0表示正北）
+            color: 箭头颜色
+            size: 箭头大小
+        """
+        # 转换为像素坐标
+        x, y = self.latlon_to_pixel(lat, lon)
+        
+        # 颜色名转换为 OpenCV 的 BGRA
+        r, g, b = ImageColor.getrgb(color)[:3]
+        color_bgra = (b, g, r, 255)
+        
+        # 将地理方向转换为图像坐标系（顺时针旋转90度）
+        angle_rad = math.radians(direction - 90)
+        c, s = math.cos(angle_rad), math.sin(angle_rad)
+        rotation = np.array([[c, -s], [s, c]])
+        
+        # 一次矩阵乘法得到箭头尖端、左翼、右翼和箭头杆末端
+        points = np.rint((self._ARROW_BODY @ rotation.T) * size + (x, y)).astype(np.int32)
+        head, shaft_end = points[:3], tuple(points[3].tolist())
+        
+        # 绘制箭头（实心三角形）
+        cv2.fillPoly(self.image, [head], color_bgra)
+        cv2.polylines(self.image, [head], True, (0, 0, 0, 255), 1)
+        
+        # 绘制箭头杆
+        cv2.line(self.image, (x, y), shaft_end, color_bgra, 5)
+        
+        # 绘制中心点
+        # draw.ellipse(
+        #     [(x-5, y-5), (x+5, y+5)],
+        #     fill='blue',
+        #     outline='white'
+        # )
+        
+        return self.image
+    
+    def save(self, output_path):
+        """保存结果图片"""
+        cv2.imwrite(output_path, self.image)
+
+    def to_png_bytes(self):
+        """将结果图片编码为 PNG 字节串（低压缩级别，编码更快）"""
+        ok, encoded = cv2.imencode('.png', self.image, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        if not ok:
+            raise ValueError('Failed to encode map image as PNG')
+        return encoded.tobytes()
+    
+    def show(self):
+        """显示图片"""
+        Image.fromarray(cv2.cvtColor(self.image, cv2.COLOR_BGRA2RGBA)).show()
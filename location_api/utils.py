@@ -1,23 +1,108 @@
 # location_api/utils.py
 
+import asyncio
+import hashlib
+import json
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+
 import google.generativeai as genai
 from django.conf import settings
 from pathlib import Path
 
 
-def upload_pdf_to_gemini(pdf_path):
+# 已上传到 Gemini 的文件缓存：(文件路径或 MIME 类型, 内容摘要) -> genai.File
+# 每个 worker 进程各自一份；按内容摘要判断，相同的地图只上传一次
+_PDF_CACHE = {}
+_PDF_CACHE_MAX_SIZE = 128
+# 距离过期不足这个时间的文件需要重新上传
+_PDF_EXPIRY_MARGIN = timedelta(seconds=60)
+
+
+def _file_digest(path):
+    """计算文件内容的 sha256 摘要"""
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+
+def _is_file_usable(file):
+    """缓存的文件处于 ACTIVE 状态且未临近过期才可复用"""
+    if file.state.name != 'ACTIVE':
+        return False
+    expiration = file.expiration_time
+    return expiration is None or expiration > datetime.now(timezone.utc) + _PDF_EXPIRY_MARGIN
+
+
+async def upload_pdf_to_gemini(source, mime_type=None):
     """
     将PDF文件上传到Gemini（用于多模态处理）
+
+    SDK 没有提供异步上传接口，放到线程中执行，避免阻塞事件循环。
+    相同内容的文件只上传一次，之后直接复用缓存的文件句柄
+
+    Args:
+        source: 文件路径，或内存中的文件内容（bytes）
+        mime_type: source 为 bytes 时必须指定，如 'image/png'
     """
     try:
+        if isinstance(source, bytes):
+            key = (mime_type, hashlib.sha256(source).hexdigest())
+        else:
+            key = (str(source), await asyncio.to_thread(_file_digest, source))
+        file = _PDF_CACHE.get(key)
+        if file is not None and _is_file_usable(file):
+            return file
+
         genai.configure(api_key=settings.GEMINI_API_KEY)
-        file = genai.upload_file(pdf_path)
+        if isinstance(source, bytes):
+            file = await asyncio.to_thread(genai.upload_file, BytesIO(source), mime_type=mime_type)
+        else:
+            file = await asyncio.to_thread(genai.upload_file, source, mime_type=mime_type)
+
+        _PDF_CACHE.pop(key, None)
+        if len(_PDF_CACHE) >= _PDF_CACHE_MAX_SIZE:
+            # 淘汰最早放入的条目
+            _PDF_CACHE.pop(next(iter(_PDF_CACHE)))
+        _PDF_CACHE[key] = file
         return file
     except Exception as e:
         print(f"Error uploading PDF: {str(e)}")
         return None
 
-def query_gemini_location(direction, gps, map_context):
+# Gemini 结构化输出：只返回建筑名
+_LOCATION_GENERATION_CONFIG = {
+    'response_mime_type': 'application/json',
+    'response_schema': {
+        'type': 'object',
+        'properties': {
+            'building_name': {'type': 'string'}
+        },
+        'required': ['building_name']
+    }
+}
+
+async def _generate_building_name(model_name, prompt, map_context):
+    """
+    调用指定的 Gemini 模型并解析出建筑名，回答不符合格式时抛出 ValueError / KeyError
+    """
+    # 选择模型
+    model = genai.GenerativeModel(
+        model_name,
+        generation_config=_LOCATION_GENERATION_CONFIG
+    )
+
+    # 如果有上传的PDF文件
+    if not isinstance(map_context, str):
+        response = await model.generate_content_async([prompt, map_context])
+    else:
+        response = await model.generate_content_async(prompt)
+    print(response.text)
+    building_name = json.loads(response.text)['building_name']
+    if not isinstance(building_name, str) or not building_name.strip():
+        raise ValueError(f"Invalid building_name in Gemini response: {building_name!r}")
+    return building_name.strip()
+
+async def query_gemini_location(direction, gps, map_context):
     """
     使用Gemini API查询当前位置
     
@@ -25,6 +110,9 @@ def query_gemini_location(direction, gps, map_context):
         direction: 方向信息（如"北"、"East"等）
         gps: GPS坐标字典 {"latitude": xx, "longitude": xx}
         map_context: 地图文本内容或文件引用
+
+    Returns:
+        dict: 成功时 location 为建筑名
     """
     # 配置 Gemini API
     genai.configure(api_key=settings.GEMINI_API_KEY)
@@ -35,24 +123,25 @@ def query_gemini_location(direction, gps, map_context):
 Only based on this image
 {map_context}
 
-Think it step by step, first describe the image, then find out where is the arraw, then find out which buiding it is point to, then give your answer, which is the buiding's name in this format: /*** BUIDING_NAME ***/
+Think it step by step, first find out where is the arraw, then find out which buiding it is point to, then give the buiding's name as building_name.
 
 """
     
     try:
-        # 选择模型
-        model = genai.GenerativeModel('gemini-2.5-pro')
-        
-        # 如果有上传的PDF文件
-        if not isinstance(map_context, str):
-            response = model.generate_content([prompt, map_context])
-        else:
-            response = model.generate_content(prompt)
-        print(response.text)
+        model_name = settings.GEMINI_MODEL_NAME
+        try:
+            building_name = await _generate_building_name(model_name, prompt, map_context)
+        except (ValueError, KeyError, TypeError):
+            # 快速模型的回答不符合 JSON 格式时，换用更强的模型重试
+            fallback_model_name = settings.GEMINI_FALLBACK_MODEL_NAME
+            if not fallback_model_name or fallback_model_name == model_name:
+                raise
+            model_name = fallback_model_name
+            building_name = await _generate_building_name(model_name, prompt, map_context)
         return {
             'success': True,
-            'location': response.text,
-            'model': 'gemini-2.5-pro'
+            'location': building_name,
+            'model': model_name
         }
     
     except Exception as e:
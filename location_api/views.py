@@ -1,215 +1,98 @@
 # location_api/views.py
 
+import asyncio
 import json
 import base64
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.conf import settings
+from django.core.cache import cache
+from .map_marker import MapMarker
 from .utils import upload_pdf_to_gemini, query_gemini_location
 from PIL import Image, ImageDraw, ImageFont
 from ultralytics import YOLO
-import os
+import torch
 import random
+import threading
+import uuid
 from io import BytesIO
-import re
 
-import math
+_YOLO_MODEL = None
+# 有 GPU 时用 GPU + FP16 推理，否则退回 CPU + FP32
+_YOLO_DEVICE = 0 if torch.cuda.is_available() else 'cpu'
+_YOLO_HALF = _YOLO_DEVICE != 'cpu'
+# ultralytics 的模型对象不是线程安全的，加载和推理都需要加锁
+_YOLO_LOCK = threading.Lock()
 
-def extract_between_markers(text):
+def get_yolo():
     """
-    提取 /*** 和 ***/ 之间的内容
-    
-    Args:
-        text: 输入字符串
-    
-    Returns:
-        str: 提取的内容，如果没有匹配则返回 None
+    获取全局共享的 YOLO 模型，首次调用时加载权重
     """
-    pattern = r'/\*\*\*(.*?)\*\*\*/'
-    match = re.search(pattern, text, re.DOTALL)
-    
-    if match:
-        return match.group(1).strip()  # .strip() 去除首尾空白
-    return None
+    global _YOLO_MODEL
+    with _YOLO_LOCK:
+        if _YOLO_MODEL is None:
+            _YOLO_MODEL = YOLO('yolov8n.pt')
+    return _YOLO_MODEL
 
+def detect_building(img):
+    """
+    用 YOLO 找出图中面积最大的对象作为建筑物
 
+    Args:
+        img: RGB 模式的 PIL 图片（ultralytics 会把 numpy 数组当作 BGR，所以直接传 PIL 图片）
 
-class MapMarker:
-    def __init__(self, image_path, corners):
-        """
-        初始化地图标记器
-        
-        Args:
-            image_path: 地图图片路径
-            corners: 地图四个角的经纬度，格式：
-                {
-                    'top_left': (lat, lon),
-                    'top_right': (lat, lon),
-                    'bottom_left': (lat, lon),
-                    'bottom_right': (lat, lon)
-                }
-        """
-        self.image = Image.open(image_path)
-        self.width, self.height = self.image.size
-        self.corners = corners
-        
-    def latlon_to_pixel(self, lat, lon):
-        """
-        将经纬度转换为图片像素坐标
-        
-        使用简单的线性插值（适用于小范围地图）
-        """
-        # 获取四个角的坐标
-        tl_lat, tl_lon = self.corners['top_left']
-        tr_lat, tr_lon = self.corners['top_right']
-        bl_lat, bl_lon = self.corners['bottom_left']
-        br_lat, br_lon = self.corners['bottom_right']
-        
-        # 计算纬度范围
-        lat_min = min(tl_lat, tr_lat, bl_lat, br_lat)
-        lat_max = max(tl_lat, tr_lat, bl_lat, br_lat)
-        
-        # 计算经度范围
-        lon_min = min(tl_lon, tr_lon, bl_lon, br_lon)
-        lon_max = max(tl_lon, tr_lon, bl_lon, br_lon)
-        
-        # 线性插值到像素坐标
-        # 注意：纬度是反向的（北纬越大，y 坐标越小）
-        x = (lon - lon_min) / (lon_max - lon_min) * self.width
-        y = (lat_max - lat) / (lat_max - lat_min) * self.height
-        
-        return int(x), int(y)
+    Returns:
+        list: 边框 [x1, y1, x2, y2]
+    """
+    yolo = get_yolo()
     
-    def draw_arrow(self, lat, lon, direction, color='red', size=50):
-        """
-        在指定经纬度位置画箭头
-        
-        Args:
-            lat: 纬度
-            lon: 经度
-            direction: 方向角度（0-360度，0表示正北）
-            color: 箭头颜色
-            size: 箭头大小
-        """
-        # 转换为像素坐标
-        x, y = self.latlon_to_pixel(lat, lon)
-        
-        # 创建可绘制对象
-        draw = ImageDraw.Draw(self.image)
-        
-        # 计算箭头的三个顶点
-        # 将地理方向转换为图像坐标系（顺时针旋转90度）
-        angle_rad = math.radians(direction - 90)
-        
-        # 箭头尖端
-        tip_x = x + size * 0.3 * math.cos(angle_rad)
-        tip_y = y + size * 0.3 * math.sin(angle_rad)
-        
-        # 箭头左翼
-        left_angle = angle_rad + math.radians(150)
-        left_x = x + (size * 0.5) * math.cos(left_angle)
-        left_y = y + (size * 0.5) * math.sin(left_angle)
-        
-        # 箭头右翼
-        right_angle = angle_rad - math.radians(150)
-        right_x = x + (size * 0.5) * math.cos(right_angle)
-        right_y = y + (size * 0.5) * math.sin(right_angle)
-        
-        # 绘制箭头（实心三角形）
-        draw.polygon(
-            [(tip_x, tip_y), (left_x, left_y), (right_x, right_y)],
-            fill=color,
-            outline='black'
-        )
-        
-        # 绘制箭头杆
-        shaft_length = size * 2
-        shaft_end_x = x - shaft_length * math.cos(angle_rad)
-        shaft_end_y = y - shaft_length * math.sin(angle_rad)
-        draw.line(
-            [(x, y), (shaft_end_x, shaft_end_y)],
-            fill=color,
-            width=5
+    # 检测最大对象
+    with _YOLO_LOCK:
+        results = yolo(
+            img,
+            conf=0.2,
+            verbose=False,
+            device=_YOLO_DEVICE,
+            half=_YOLO_HALF,
+            imgsz=640
         )
-        
-        # 绘制中心点
-        # draw.ellipse(
-        #     [(x-5, y-5), (x+5, y+5)],
-        #     fill='blue',
-        #     outline='white'
-        # )
-        
-        return self.image
     
-    def save(self, output_path):
-        """保存结果图片"""
-        self.image.save(output_path)
+    best_box = None
     
-    def show(self):
-        """显示图片"""
-        self.image.show()
-
-def random_value_generator():
-    """
+    # 所有边框一次性拷回 CPU，用 numpy 找面积最大的
+    xyxy = results[0].boxes.xyxy.cpu().numpy()
+    if len(xyxy):
+        areas = (xyxy[:, 2] - xyxy[:, 0]) * (xyxy[:, 3] - xyxy[:, 1])
+        best_box = xyxy[areas.argmax()].astype(int).tolist()
     
-    Yields:
-        tuple: (value1, value2)
-    """
-    while True:
-        value1 = random.uniform(0, 0.2)
-        value2 = random.uniform(0.8, 1)
-        yield value1, value2
+    # 如果没检测到，使用全图
+    if best_box is None:
+        w, h = img.size
+        v1 = random.uniform(0, 0.2)
+        v2 = random.uniform(0.8, 1)
+        best_box = [int(w*v1), int(h*v1), int(w*v2), int(h*v2)]
+
+    return best_box
 
-gen = random_value_generator()
+# 标注文字用的字体，启动时加载一次
+_LABEL_FONT = ImageFont.load_default(120)
 
-def annotate_building(image_path, label, output_path):
+def annotate_building(img, label, best_box):
     """
     一键标注建筑物（最简版本）
     
     Args:
-        image_path: 图片路径
+        img: 待标注的 PIL 图片（会被直接修改）
         label: 建筑名称
-        output_path: 输出路径（可选）
+        best_box: detect_building 返回的边框
     
     Returns:
-        str: 输出文件路径
+        bytes: 标注后图片的 JPEG 数据
     """
-    # 自动生成输出路径
-    if output_path is None:
-        base, ext = os.path.splitext(image_path)
-        output_path = f"{base}_labeled{ext}"
-    
-    # 加载模型
-    yolo = YOLO('yolov8n.pt')
-    
-    # 检测最大对象
-    results = yolo(image_path, conf=0.2, verbose=False)
-    
-    max_area = 0
-    best_box = None
-    
-    for result in results:
-        for box in result.boxes:
-            x1, y1, x2, y2 = box.xyxy[0].cpu().numpy()
-            area = (x2 - x1) * (y2 - y1)
-            if area > max_area:
-                max_area = area
-                best_box = [int(x1), int(y1), int(x2), int(y2)]
-    
-    # 如果没检测到，使用全图
-    if best_box is None:
-        img = Image.open(image_path)
-        w, h = img.size
-        v1, v2 = next(gen)
-        best_box = [int(w*v1), int(h*v1), int(w*v2), int(h*v2)]
-    
-    # 加载图片
-    img = Image.open(image_path)
     draw = ImageDraw.Draw(img)
     
-    # 加载字体
-    font = ImageFont.load_default(120)
+    font = _LABEL_FONT
     
     # 绘制边框
     draw.rectangle(best_box, outline='red', width=4)
@@ -233,30 +116,187 @@ def annotate_building(image_path, label, output_path):
     
 
     buffer = BytesIO()
-    # 保存
-    img.save(buffer, format='JPEG')
-    base64_str = base64.b64encode(buffer.getvalue()).decode('utf-8')
-    annotated_data_uri = f"{base64_str}"
-    return annotated_data_uri
+    # 保存（参数显式固定：4:2:0 色度抽样，不做 Huffman 优化和渐进编码，编码最快）
+    img.save(buffer, format='JPEG', quality=75, subsampling=2, optimize=False, progressive=False)
+    return buffer.getvalue()
+
+# 校园地图 map_png.png 四个角的经纬度
+CAMPUS_CORNERS = {
+    'top_left': (32.99563626626291, -96.75615546459603),      # 左上角
+    'top_right': (32.99562635860259, -96.74429935194813),     # 右上角
+    'bottom_left': (32.9828203491122, -96.75615546459603),   # 左下角
+    'bottom_right': (32.9828203491122, -96.74429935194813)   # 右下角
+}
+
+def render_map_marker(gps, direction):
+    """
+    在地图上标出当前位置和朝向
+
+    Returns:
+        bytes: 标注后地图的 PNG 数据（直接在内存中交给 Gemini，不落盘）
+    """
+    # 创建标记器
+    marker = MapMarker('map_png.png', CAMPUS_CORNERS)
+
+    marker.draw_arrow(
+        lat=gps['latitude'],
+        lon=gps['longitude'],
+        direction=direction,
+        color='purple',
+        size=20
+    )
+
+    return marker.to_png_bytes()
+
+
+def decode_building_image(image_source):
+    """
+    解码客户端上传的照片并旋转，全程在内存中处理，不落盘
+
+    Args:
+        image_source: multipart 上传的文件对象，或 base64 字符串
+
+    Returns:
+        Image: RGB 模式的 PIL 图片，供 YOLO 检测和标注共用
+    """
+    if isinstance(image_source, str):
+        image_source = BytesIO(base64.b64decode(image_source))
+    img = Image.open(image_source)
+    # 顺时针旋转 90 度：纯像素重排，不做插值
+    rotated = img.transpose(Image.Transpose.ROTATE_270)
+    return rotated.convert('RGB')
+
+
+def location_cache_key(gps, direction):
+    """
+    生成识别结果的缓存键：GPS 取 4 位小数（约 10 米），方向取整数角度
+    """
+    lat = round(float(gps['latitude']), 4)
+    lon = round(float(gps['longitude']), 4)
+    heading = round(float(direction)) % 360
+    return f"loc:{lat}:{lon}:{heading}"
+
+
+async def locate_building(gps, direction, need_map=False):
+    """
+    画出箭头地图并上传给 Gemini，查询箭头指向的建筑
+
+    附近位置、相同朝向的查询结果会被缓存，命中时跳过上传和 Gemini 调用
+
+    Args:
+        need_map: 命中缓存时是否仍需要画出地图
+
+    Returns:
+        tuple: (Gemini 查询结果, 标注后地图的 PNG 数据；命中缓存且不需要地图时为 None)
+    """
+    cache_key = location_cache_key(gps, direction)
+    cached_result = await cache.aget(cache_key)
+    if cached_result is not None:
+        map_png = await asyncio.to_thread(render_map_marker, gps, direction) if need_map else None
+        return cached_result, map_png
+
+    map_png = await asyncio.to_thread(render_map_marker, gps, direction)
+
+    map_file = await upload_pdf_to_gemini(map_png, mime_type='image/png')
+
+    # map_context = map_file if map_file else map_text
+
+    # 使用文本方式
+    map_context = map_file
+
+    # 查询 Gemini
+    result = await query_gemini_location(direction, gps, map_context)
+    if result['success']:
+        await cache.aset(cache_key, result, settings.LOCATION_CACHE_TTL)
+    return result, map_png
+
+
+async def detect_building_in_photo(image_source):
+    """
+    解码客户端照片并检测其中的建筑物边框
+
+    Returns:
+        tuple: (照片, 边框)
+    """
+    photo = await asyncio.to_thread(decode_building_image, image_source)
+    best_box = await asyncio.to_thread(detect_building, photo)
+    return photo, best_box
+
+
+def multipart_response(payload, parts, status=200):
+    """
+    构造 multipart/related 响应：第一部分为 JSON，其余部分为原始图片数据，
+    省去 base64 带来的 33% 体积膨胀和编码开销
+
+    Args:
+        payload: JSON 部分的内容
+        parts: [(名称, Content-Type, bytes), ...]
+    """
+    boundary = uuid.uuid4().hex
+    body = BytesIO()
+    all_parts = [('payload', 'application/json', json.dumps(payload).encode('utf-8'))] + parts
+    for name, content_type, content in all_parts:
+        body.write(f'--{boundary}\r\n'.encode('ascii'))
+        body.write(f'Content-Type: {content_type}\r\n'.encode('ascii'))
+        body.write(f'Content-ID: <{name}>\r\n\r\n'.encode('ascii'))
+        body.write(content)
+        body.write(b'\r\n')
+    body.write(f'--{boundary}--\r\n'.encode('ascii'))
+
+    return HttpResponse(
+        body.getvalue(),
+        content_type=f'multipart/related; boundary="{boundary}"; type="application/json"',
+        status=status
+    )
+
+
+def parse_form_data(request):
+    """
+    将 multipart/form-data 请求转换为与 JSON 请求相同结构的字典
+
+    表单字段：direction、gps（JSON 字符串）、image（图片文件）、
+    return_map_png / response_format（可选）
+    """
+    data = request.POST.dict()
+    if 'gps' in data:
+        data['gps'] = json.loads(data['gps'])
+    if 'return_map_png' in data:
+        data['return_map_png'] = data['return_map_png'].lower() in ('1', 'true')
+    if 'image' in request.FILES:
+        data['image'] = request.FILES['image']
+    return data
+
 
 @csrf_exempt
 @require_http_methods(["POST"])
-def identify_location(request):
+async def identify_location(request):
     """
     API endpoint: 接收 GPS 和方向数据，返回位置识别结果
-    
+
+    阻塞的绘图 / YOLO 计算放到线程中执行，Gemini 调用使用异步接口，
+    需要通过 ASGI（如 uvicorn building.asgi:application）部署
+
     Request Body (JSON):
     {
-        "direction": "北",
+        "direction": 0,             // 方向角度（0-360度，0表示正北）
         "gps": {
             "latitude": 39.9042,
             "longitude": 116.4074
-        }
+        },
+        "return_map_png": false,    // 可选，为 true 时在 map_image 中返回标注后的地图
+        "response_format": "json"   // 可选，"multipart" 时返回 multipart/related，
+                                    // 图片以原始字节作为单独的部分返回
     }
+
+    也可以用 multipart/form-data 上传：照片放在文件字段 image 中，省去 base64 编解码，
+    gps 字段为 JSON 字符串，其余字段同上（见 parse_form_data）
     """
     try:
-        # 解析 JSON 数据
-        data = json.loads(request.body)
+        if request.content_type == 'multipart/form-data':
+            data = parse_form_data(request)
+        else:
+            # 解析 JSON 数据
+            data = json.loads(request.body)
         
         # 验证必需字段
         if 'direction' not in data or 'gps' not in data:
@@ -265,78 +305,64 @@ def identify_location(request):
                 'error': 'Missing required fields: direction and gps'
             }, status=400)
         
-        direction = data['direction']
+        # 表单字段都是字符串，统一转换为角度数值
+        try:
+            direction = float(data['direction'])
+        except (TypeError, ValueError):
+            return JsonResponse({
+                'success': False,
+                'error': 'direction must be a number (0-360, 0 = north)'
+            }, status=400)
         gps = data['gps']
-        base64_string = data['image_base64']
-
-        corners = {
-            'top_left': (32.99563626626291, -96.75615546459603),      # 左上角
-            'top_right': (32.99562635860259, -96.74429935194813),     # 右上角
-            'bottom_left': (32.9828203491122, -96.75615546459603),   # 左下角
-            'bottom_right': (32.9828203491122, -96.74429935194813)   # 右下角
-        }
-        
-        # 创建标记器
-        marker = MapMarker('map_png.png', corners)
-        
+        # 优先使用 multipart 上传的原始图片，兼容旧客户端的 base64
+        image_source = data.get('image') or data.get('image_base64')
+        if image_source is None:
+            return JsonResponse({
+                'success': False,
+                'error': 'Missing required field: image or image_base64'
+            }, status=400)
 
-        marker.draw_arrow(
-            lat=gps['latitude'],
-            lon=gps['longitude'],
-            direction=direction,
-            color='purple',
-            size=20
-        )
-        
-        marker.save('output_map.png')
-        
         # 验证 GPS 数据
         if 'latitude' not in gps or 'longitude' not in gps:
             return JsonResponse({
                 'success': False,
                 'error': 'GPS must contain latitude and longitude'
             }, status=400)
-        
 
+        # 地图标注 -> 上传 -> Gemini 查询 与 照片解码 -> YOLO 检测 互不依赖，并发执行
+        (result, map_png), (photo, best_box) = await asyncio.gather(
+            locate_building(gps, direction, need_map=bool(data.get('return_map_png'))),
+            detect_building_in_photo(image_source)
+        )
         
-        # 读取地图文件
-        map_pdf_path = settings.MAP_PDF_PATH
-        
-        map_file = upload_pdf_to_gemini(map_pdf_path)
+        if not result['success']:
+            return JsonResponse({
+                'success': False,
+                'error': result['error']
+            }, status=500)
 
-        # map_context = map_file if map_file else map_text
-        
-        # 使用文本方式
-        map_context = map_file
-        
-        # 查询 Gemini
-        result = query_gemini_location(direction, gps, map_context)
+        building_name = result['location']
         
-        building_name = extract_between_markers(result['location'])
+        labeled_jpeg = await asyncio.to_thread(annotate_building, photo, building_name, best_box)
 
-        image_data = base64.b64decode(base64_string)
-        img = Image.open(BytesIO(image_data))
-        rotated = img.rotate(-90, expand=True)
-        rotated.save("./building.png", 'PNG')
-        
-        img_base64 = annotate_building("./building.png", building_name, '')
-        # print(img_base64)
+        response_data = {
+            'success': True,
+            'direction': direction,
+            'gps': gps,
+            'location_info': building_name,
+            'model': result['model']
+        }
 
+        if data.get('response_format') == 'multipart':
+            parts = [('labeled_image', 'image/jpeg', labeled_jpeg)]
+            if data.get('return_map_png'):
+                parts.append(('map_image', 'image/png', map_png))
+            return multipart_response(response_data, parts, status=200)
 
-        if result['success']:
-            return JsonResponse({
-                'success': True,
-                'direction': direction,
-                'gps': gps,
-                'location_info': building_name,
-                'labeled_image': img_base64,
-                'model': result['model']
-            }, status=200)
-        else:
-            return JsonResponse({
-                'success': False,
-                'error': result['error']
-            }, status=500)
+        response_data['labeled_image'] = base64.b64encode(labeled_jpeg).decode('utf-8')
+        if data.get('return_map_png'):
+            response_data['map_image'] = base64.b64encode(map_png).decode('utf-8')
+        return JsonResponse(response_data, status=200)
     
     except json.JSONDecodeError:
         return JsonResponse({